@@ -3,15 +3,23 @@ import shutil
 import uuid
 import datetime
 import json
-from flask import Flask, request, jsonify, send_from_directory, session
+import html
+from flask import Flask, Response, request, jsonify, send_from_directory, session, stream_with_context
 from dotenv import load_dotenv
 from openai import OpenAI
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 import base64
 import requests
 from flask_cors import CORS
 import sqlite3
+import threading
+import time
+import zipfile
+import array
+from collections import OrderedDict
+import click
+import numpy as np
 
 load_dotenv()
 # Create the OpenAI client
@@ -31,6 +39,43 @@ if not os.path.exists(REFERENCE_IMAGE_PATH):
     # For now, we'll assume this step is done manually
     pass
 
+# Similar-garment index: one feature vector per stored input image, memory-mapped from disk.
+# It is guarded by a thread lock only, so it supports a single server process.
+GARMENT_INDEX_PATH = os.path.join(os.path.dirname(__file__), 'garment_index.npy')
+GARMENT_FEATURE_DIM = 112  # 8x8 grayscale thumbnail + 8x3x2 HSV colour histogram
+# Cosine similarity above which two uploads are treated as the same garment
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", 0.95))
+# Reuse a matching session's outfits instead of generating new ones unless the request says otherwise
+SIMILARITY_AUTO_REUSE = os.getenv("SIMILARITY_AUTO_REUSE", "false").lower() == "true"
+# Imports skip the similar-garment index, which is filled from the images afterwards
+IMPORT_GARMENT_INDEX_HINT = "Run 'flask --app main backfill-garment-index' to add imported sessions to the similar-garment index"
+# Rankings of recent searches are kept until style_data changes, so later pages skip ranking every match
+SEARCH_CACHE_SIZE = 16
+search_cache = OrderedDict()  # FTS5 query -> (search index version, ranked style_data ids)
+search_cache_lock = threading.Lock()
+# Private use characters mark matches in snippets until the text around them is escaped
+SNIPPET_MATCH_START = '\ue000'
+SNIPPET_MATCH_END = '\ue001'
+
+garment_index = None
+garment_index_lock = threading.Lock()
+
+# Retention policy for public/history. Ages are in days and 0 disables a rule.
+HISTORY_DISK_BUDGET_MB = int(os.getenv("HISTORY_DISK_BUDGET_MB", 0))
+RETENTION_COMPACT_AFTER_DAYS = int(os.getenv("RETENTION_COMPACT_AFTER_DAYS", 0))
+RETENTION_EVICT_AFTER_DAYS = int(os.getenv("RETENTION_EVICT_AFTER_DAYS", 0))
+# With every rule off there is nothing to do, so no pass runs at all
+RETENTION_ENABLED = bool(HISTORY_DISK_BUDGET_MB or RETENTION_COMPACT_AFTER_DAYS or RETENTION_EVICT_AFTER_DAYS)
+RETENTION_COMPACT_MAX_SIZE = int(os.getenv("RETENTION_COMPACT_MAX_SIZE", 512))  # Longest side in pixels
+RETENTION_WEBP_QUALITY = int(os.getenv("RETENTION_WEBP_QUALITY", 80))
+# Evicted sessions are saved here as import-history archives; empty means evict without archiving
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), 'archive'))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", 3600))
+RETENTION_BATCH_SIZE = 20  # Sessions handled per database read
+RETENTION_STEP_PAUSE_SECONDS = 0.05  # Pause between sessions so request handling is never starved
+retention_lock = threading.Lock()
+retention_worker = None
+
 
 def get_db_connection():
     """Create a connection to the SQLite database"""
@@ -39,6 +84,19 @@ def get_db_connection():
     conn.row_factory = sqlite3.Row  # This enables column access by name
     return conn
 
+def decoded_details_sql(column):
+    """SQL expression turning a stored JSON list of details into plain text for the search index"""
+    return f"CASE WHEN json_valid({column}) THEN (SELECT group_concat(value, ', ') FROM json_each({column})) ELSE {column} END"
+
+def fill_search_index(cursor):
+    """Replace the contents of the search index with every row of style_data, without committing"""
+    cursor.execute('DELETE FROM style_search')
+    cursor.execute(f'''
+    INSERT INTO style_search (rowid, details, suggestion_party, suggestion_office, suggestion_vacation)
+    SELECT id, {decoded_details_sql('details')}, suggestion_party, suggestion_office, suggestion_vacation
+    FROM style_data
+    ''')
+
 # Call at startup
 def initialize_db():
     """Create the necessary tables if they don't exist"""
@@ -82,10 +140,116 @@ def initialize_db():
         FOREIGN KEY (session_id) REFERENCES sessions (session_id)
     )
     ''')
-    
+
+    # Index the session_id lookups done for every history item
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_generated_images_session_id ON generated_images (session_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_style_data_session_id ON style_data (session_id)')
+
+    # Create full-text index over style details and suggestions.
+    # It stores the details decoded from their JSON list, so accented text is indexed as written.
+    # Schema changes run in one transaction, so an interrupted migration is retried on the next start.
+    cursor.execute('BEGIN')
+    cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'style_search'")
+    search_index = cursor.fetchone()
+    if search_index and 'content=' in search_index['sql']:
+        # Earlier indexes read the raw JSON from style_data, drop them so they are rebuilt below
+        cursor.execute('DROP TABLE style_search')
+        for trigger in ('style_data_ai', 'style_data_ad', 'style_data_au'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        search_index = None
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS style_search USING fts5 (
+        details,
+        suggestion_party,
+        suggestion_office,
+        suggestion_vacation,
+        tokenize='porter unicode61'
+    )
+    ''')
+    if search_index is None:
+        # Index sessions saved before the search index existed
+        fill_search_index(cursor)
+
+    # Keep the search index in sync with style_data
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS style_data_ai AFTER INSERT ON style_data BEGIN
+        INSERT INTO style_search (rowid, details, suggestion_party, suggestion_office, suggestion_vacation)
+        VALUES (new.id, {decoded_details_sql('new.details')}, new.suggestion_party, new.suggestion_office, new.suggestion_vacation);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS style_data_ad AFTER DELETE ON style_data BEGIN
+        DELETE FROM style_search WHERE rowid = old.id;
+    END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS style_data_au AFTER UPDATE ON style_data BEGIN
+        DELETE FROM style_search WHERE rowid = old.id;
+        INSERT INTO style_search (rowid, details, suggestion_party, suggestion_office, suggestion_vacation)
+        VALUES (new.id, {decoded_details_sql('new.details')}, new.suggestion_party, new.suggestion_office, new.suggestion_vacation);
+    END
+    ''')
+
+    # Count changes to style_data, so cached search rankings can tell when they are stale
+    cursor.execute('CREATE TABLE IF NOT EXISTS search_index_version (version INTEGER)')
+    cursor.execute('INSERT INTO search_index_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM search_index_version)')
+    for trigger, event in (('style_data_version_ai', 'INSERT'), ('style_data_version_ad', 'DELETE'), ('style_data_version_au', 'UPDATE')):
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON style_data BEGIN
+            UPDATE search_index_version SET version = version + 1;
+        END
+        ''')
+
+    # Map rows of the garment feature index to the session they were computed for
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS garment_features (
+        vector_row INTEGER PRIMARY KEY,
+        session_id TEXT UNIQUE,
+        FOREIGN KEY (session_id) REFERENCES sessions (session_id)
+    )
+    ''')
+
+    # Track how far retention has compacted each session's images
+    cursor.execute('PRAGMA table_info(sessions)')
+    if 'storage_tier' not in [column['name'] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE sessions ADD COLUMN storage_tier TEXT DEFAULT 'original'")
+
+    # Create retention_runs table for the space reclaimed report
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS retention_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at INTEGER,
+        finished_at INTEGER,
+        compacted INTEGER,
+        evicted INTEGER,
+        archived INTEGER,
+        bytes_reclaimed INTEGER,
+        usage_bytes INTEGER
+    )
+    ''')
+
     conn.commit()
     conn.close()
 
+def rebuild_search_index():
+    """Rebuild the full-text search index from the style_data table"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    fill_search_index(cursor)
+    cursor.execute('SELECT COUNT(*) FROM style_data')
+    indexed = cursor.fetchone()[0]
+
+    conn.commit()
+    conn.close()
+    return indexed
+
+@app.cli.command('backfill-search')
+def backfill_search_command():
+    """Index existing sessions for /history/search"""
+    indexed = rebuild_search_index()
+    print(f"Indexed {indexed} sessions")
+
 # Helper to convert image to base64
 def image_to_base64(image_file):
     """Convert an image file to base64 encoding"""
@@ -118,6 +282,25 @@ def get_session_folder():
     os.makedirs(base_folder, exist_ok=True)
     return base_folder
 
+def get_local_image_path(image_path):
+    """Resolve an image path stored relative to public, which may use Windows separators"""
+    return os.path.join('public', image_path.replace('\\', '/'))
+
+def is_history_file(local_path):
+    """Check that a local path resolves to somewhere inside public/history"""
+    history_folder = os.path.realpath(os.path.join('public', 'history'))
+    try:
+        return os.path.commonpath([history_folder, os.path.realpath(local_path)]) == history_folder
+    except ValueError:
+        return False  # On another drive
+
+def sanitize_history_path(image_path):
+    """Reduce an untrusted image path to a plain file name in the history folder"""
+    name = os.path.basename((image_path or '').replace('\\', '/'))
+    if name in ('', '.', '..'):
+        return ''
+    return f"history/{name}"
+
 # Save history data to JSON file
 def save_history_data(data):
     session_folder = get_session_folder()
@@ -161,6 +344,15 @@ def save_history_data_sqlite(data):
     session_id = f"session-{int(datetime.datetime.now().timestamp() * 1000)}"
     created_at = int(datetime.datetime.now().timestamp() * 1000)
     
+    insert_history_record(cursor, session_id, timestamp, created_at, data)
+    
+    conn.commit()
+    conn.close()
+
+    return session_id
+
+def insert_history_record(cursor, session_id, timestamp, created_at, data):
+    """Insert a session with its style data and generated images, without committing"""
     # Insert into sessions table
     cursor.execute('''
     INSERT INTO sessions (session_id, timestamp, created_at, type, input_image_path, preview_image)
@@ -194,11 +386,189 @@ def save_history_data_sqlite(data):
         INSERT INTO generated_images (session_id, occasion, image_path)
         VALUES (?, ?, ?)
         ''', (session_id, occasion, image_path))
-    
-    conn.commit()
+
+def normalize_vector(vector):
+    """Scale a vector to unit length so dot products are cosine similarities"""
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def compute_garment_features(image_bytes):
+    """Compute a compact perceptual and colour feature vector for an apparel image"""
+    img = Image.open(io.BytesIO(image_bytes))
+    img.draft('RGB', (128, 128))  # Let JPEG decode at reduced size
+    img = img.convert('RGB').resize((64, 64))
+
+    # Layout: 8x8 grayscale thumbnail, centred so overall brightness doesn't dominate
+    thumbnail = np.asarray(img.convert('L').resize((8, 8)), dtype=np.float32).ravel()
+    thumbnail -= thumbnail.mean()
+
+    # Colour: 8 hue x 3 saturation x 2 value histogram
+    hsv = np.asarray(img.convert('HSV'), dtype=np.int32)
+    bins = (hsv[..., 0] * 8 // 256) * 6 + (hsv[..., 1] * 3 // 256) * 2 + hsv[..., 2] * 2 // 256
+    histogram = np.sqrt(np.bincount(bins.ravel(), minlength=48).astype(np.float32))
+
+    features = np.concatenate([normalize_vector(thumbnail), normalize_vector(histogram)])
+    return normalize_vector(features).astype(np.float32)
+
+def load_garment_index():
+    """Open the memory-mapped garment feature index, creating it if needed"""
+    global garment_index
+    if garment_index is None:
+        if os.path.exists(GARMENT_INDEX_PATH):
+            garment_index = np.load(GARMENT_INDEX_PATH, mmap_mode='r+')
+        else:
+            garment_index = np.lib.format.open_memmap(
+                GARMENT_INDEX_PATH, mode='w+', dtype=np.float32, shape=(1024, GARMENT_FEATURE_DIM))
+    return garment_index
+
+def grow_garment_index(min_rows):
+    """Copy the garment feature index into a larger file and reopen it"""
+    global garment_index
+    old_index = load_garment_index()
+    capacity = max(min_rows, 2 * len(old_index))
+
+    tmp_path = GARMENT_INDEX_PATH + '.tmp'
+    new_index = np.lib.format.open_memmap(
+        tmp_path, mode='w+', dtype=np.float32, shape=(capacity, GARMENT_FEATURE_DIM))
+    new_index[:len(old_index)] = old_index
+    new_index.flush()
+
+    # Drop this process's references to the old mapping so the file can be replaced.
+    # Other processes would keep mapping the old file, hence the single-process limit.
+    garment_index = None
+    del old_index, new_index
+    os.replace(tmp_path, GARMENT_INDEX_PATH)
+    return load_garment_index()
+
+def add_garment_features(session_id, features):
+    """Store the feature vector of a session's input image in the garment index"""
+    with garment_index_lock:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT COALESCE(MAX(vector_row), -1) + 1 FROM garment_features')
+        vector_row = cursor.fetchone()[0]
+
+        if vector_row >= len(load_garment_index()):
+            grow_garment_index(vector_row + 1)
+        index = load_garment_index()
+        index[vector_row] = features
+        index.flush()
+
+        cursor.execute('INSERT INTO garment_features (vector_row, session_id) VALUES (?, ?)',
+                       (vector_row, session_id))
+        conn.commit()
+        conn.close()
+
+def remove_garment_features(session_id):
+    """Remove a session from the garment index"""
+    with garment_index_lock:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT vector_row FROM garment_features WHERE session_id = ?', (session_id,))
+        row = cursor.fetchone()
+        if row:
+            # A zero vector never scores above the similarity threshold
+            index = load_garment_index()
+            index[row['vector_row']] = 0
+            index.flush()
+            cursor.execute('DELETE FROM garment_features WHERE session_id = ?', (session_id,))
+            conn.commit()
+
+        conn.close()
+
+def find_similar_garments(features, limit=5):
+    """Return (session_id, similarity) pairs for the stored garments closest to features"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT MAX(vector_row) FROM garment_features')
+    max_row = cursor.fetchone()[0]
+    if max_row is None:
+        conn.close()
+        return []
+
+    # Brute-force cosine similarity over the memory-mapped vectors
+    with garment_index_lock:
+        scores = load_garment_index()[:max_row + 1] @ features
+
+    # Only the best few candidates need a full sort
+    limit = min(limit, len(scores))
+    top_rows = np.argpartition(-scores, limit - 1)[:limit]
+    top_rows = top_rows[np.argsort(-scores[top_rows])]
+
+    placeholders = ', '.join('?' * len(top_rows))
+    cursor.execute(f'SELECT vector_row, session_id FROM garment_features WHERE vector_row IN ({placeholders})',
+                   [int(row) for row in top_rows])
+    sessions_by_row = {row['vector_row']: row['session_id'] for row in cursor.fetchall()}
     conn.close()
-    
-    return session_id
+
+    return [(sessions_by_row[int(row)], float(scores[row])) for row in top_rows if int(row) in sessions_by_row]
+
+def find_garment_matches(features):
+    """Return stored sessions similar enough to reuse, most similar first"""
+    return [
+        {'sessionId': session_id, 'similarity': round(similarity, 4)}
+        for session_id, similarity in find_similar_garments(features)
+        if similarity >= SIMILARITY_THRESHOLD
+    ]
+
+def get_session_outfits(session_id):
+    """Load a stored session's style data and outfit images, or None if any image is missing"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT * FROM style_data WHERE session_id = ?', (session_id,))
+    style_data_row = cursor.fetchone()
+    cursor.execute('SELECT occasion, image_path FROM generated_images WHERE session_id = ?', (session_id,))
+    images = cursor.fetchall()
+    conn.close()
+
+    if not style_data_row or not images:
+        return None
+    for img in images:
+        if not img['image_path'] or not os.path.exists(get_local_image_path(img['image_path'])):
+            return None
+
+    return {
+        'apparel': style_data_row['apparel'],
+        'details': json.loads(style_data_row['details']),
+        'suggestions': {
+            'party': style_data_row['suggestion_party'],
+            'office': style_data_row['suggestion_office'],
+            'vacation': style_data_row['suggestion_vacation']
+        },
+        'generated_images': {
+            img['occasion']: f"/history/{os.path.basename(img['image_path'])}" for img in images
+        }
+    }
+
+@app.cli.command('backfill-garment-index')
+def backfill_garment_index_command():
+    """Add stored input images missing from the garment index"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+    SELECT session_id, input_image_path FROM sessions
+    WHERE session_id NOT IN (SELECT session_id FROM garment_features)
+    ORDER BY created_at
+    ''')
+    sessions = cursor.fetchall()
+    conn.close()
+
+    indexed = 0
+    for session in sessions:
+        input_path = get_local_image_path(session['input_image_path'] or '')
+        try:
+            with open(input_path, 'rb') as f:
+                features = compute_garment_features(f.read())
+            add_garment_features(session['session_id'], features)
+            indexed += 1
+        except Exception as e:
+            print(f"Skipping {session['session_id']}: {e}")
+
+    print(f"Indexed {indexed} of {len(sessions)} sessions")
 @app.route('/test', methods=['GET'])
 def test():
     return "it works"
@@ -211,6 +581,24 @@ def generate_styles():
     image_file = request.files['image']
     base64_img = image_to_base64(image_file)
 
+    # Look for prior sessions with the same garment before paying for new images
+    try:
+        image_file.seek(0)
+        garment_features = compute_garment_features(image_file.read())
+        similar_sessions = find_garment_matches(garment_features)
+    except Exception as e:
+        print(f"Error checking similar garments: {e}")
+        garment_features = None
+        similar_sessions = []
+
+    reuse = request.form.get('reuse', str(SIMILARITY_AUTO_REUSE)).lower() == 'true'
+    if reuse:
+        for match in similar_sessions:
+            outfits = get_session_outfits(match['sessionId'])
+            if outfits:
+                outfits['reused_from'] = match
+                return jsonify(outfits)
+
     # Save the input image to history folder
     session_folder = get_session_folder()
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -275,13 +663,37 @@ Also, try to identify whether given apparel is male/female/unisex, accordingly d
             "output_images": local_image_paths,
             "preview_image": local_image_paths.get("party", "")  # Use party image as preview
         }
-        save_history_data_sqlite(history_data)
-        
+        session_id = save_history_data_sqlite(history_data)
+        if garment_features is not None:
+            # The outfits are already paid for, so indexing must not fail the request
+            try:
+                add_garment_features(session_id, garment_features)
+            except Exception as e:
+                print(f"Error indexing garment for session {session_id}: {e}")
+
+        # Offer earlier outfits for the same garment
+        style_data["similar_sessions"] = similar_sessions
+
         return jsonify(style_data)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/similar-garments', methods=['POST'])
+def similar_garments():
+    """Find stored sessions whose input garment matches the uploaded image"""
+    if 'image' not in request.files:
+        return jsonify({'error': 'No image uploaded'}), 400
+
+    try:
+        garment_features = compute_garment_features(request.files['image'].read())
+        matches = find_garment_matches(garment_features)
+        for match in matches:
+            match['outfits'] = get_session_outfits(match['sessionId'])
+        return jsonify({'matches': [match for match in matches if match['outfits']]})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 def get_reference_style_base64():
     """Get the reference style image as base64"""
     with open(REFERENCE_IMAGE_PATH, "rb") as image_file:
@@ -561,36 +973,722 @@ def get_history():
     
     sessions = cursor.fetchall()
     history = []
-    
+
     for session in sessions:
-        session_id = session['session_id']
-        
-        # Get style data for this session
-        cursor.execute('SELECT * FROM style_data WHERE session_id = ?', (session_id,))
-        style_data_row = cursor.fetchone()
-        
-        # Get generated images for this session
-        cursor.execute('SELECT occasion, image_path FROM generated_images WHERE session_id = ?', (session_id,))
-        images = cursor.fetchall()
-        
-        # Create history item in format matching frontend expectations
-        history_item = {
-            'sessionId': session_id,
-            'uploaded': f"/history/{os.path.basename(session['input_image_path'])}",
-            'results': [
-                {
-                    'url': f"/history/{os.path.basename(img['image_path'])}",
-                    'occasion': img['occasion'].capitalize()
-                } for img in images
-            ],
-            'createdAt': session['created_at']
-        }
-        
-        history.append(history_item)
-    
+        history.append(build_history_item(cursor, session))
+
     conn.close()
     return history
 
+def build_history_item(cursor, session):
+    """Build a history item for a sessions row in the format the frontend expects"""
+    session_id = session['session_id']
+
+    # Get generated images for this session
+    cursor.execute('SELECT occasion, image_path FROM generated_images WHERE session_id = ?', (session_id,))
+    images = cursor.fetchall()
+
+    return {
+        'sessionId': session_id,
+        'uploaded': f"/history/{os.path.basename(session['input_image_path'])}",
+        'results': [
+            {
+                'url': f"/history/{os.path.basename(img['image_path'])}",
+                'occasion': img['occasion'].capitalize()
+            } for img in images
+        ],
+        'createdAt': session['created_at']
+    }
+
+def build_search_query(text):
+    """Turn free text into an FTS5 query matching all of its terms"""
+    # Quote every term so user input can never be parsed as FTS5 syntax
+    terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+    return ' '.join(terms)
+
+def render_snippet(snippet):
+    """Escape snippet text for HTML, then turn the match markers into <b> tags"""
+    snippet = html.escape(snippet or '')
+    return snippet.replace(SNIPPET_MATCH_START, '<b>').replace(SNIPPET_MATCH_END, '</b>')
+
+def get_ranked_rowids(cursor, match):
+    """Return the style_data ids matching an FTS5 query, best first, reusing the ranking until style_data changes"""
+    cursor.execute('SELECT version FROM search_index_version')
+    version = cursor.fetchone()['version']
+    with search_cache_lock:
+        cached = search_cache.get(match)
+        if cached and cached[0] == version:
+            search_cache.move_to_end(match)
+            return cached[1]
+
+    # Rank every match, so the best one is found however old it is
+    cursor.execute('SELECT rowid FROM style_search WHERE style_search MATCH ? ORDER BY bm25(style_search)', (match,))
+    rowids = array.array('q', (row[0] for row in cursor))
+
+    with search_cache_lock:
+        search_cache[match] = (version, rowids)
+        search_cache.move_to_end(match)
+        while len(search_cache) > SEARCH_CACHE_SIZE:
+            search_cache.popitem(last=False)
+    return rowids
+
+def search_history(text, page=1, per_page=20):
+    """Search session history by style details and suggestions, best matches first"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    match = build_search_query(text)
+
+    ranked_rowids = get_ranked_rowids(cursor, match)
+    start = (page - 1) * per_page
+    rowids = list(ranked_rowids[start:start + per_page])
+
+    # Build snippets for this page only; the snippet shows the best matching column
+    snippets = {}
+    if rowids:
+        placeholders = ', '.join('?' * len(rowids))
+        cursor.execute(f'''
+        SELECT rowid, snippet(style_search, -1, ?, ?, '...', 16) AS snippet
+        FROM style_search
+        WHERE style_search MATCH ? AND rowid IN ({placeholders})
+        ''', [SNIPPET_MATCH_START, SNIPPET_MATCH_END, match] + rowids)
+        # Stored text may come from an imported file, so it is escaped before any markup is added
+        snippets = {row['rowid']: render_snippet(row['snippet']) for row in cursor.fetchall()}
+
+    results = []
+    for rowid in rowids:
+        cursor.execute('''
+        SELECT sessions.* FROM style_data
+        JOIN sessions ON sessions.session_id = style_data.session_id
+        WHERE style_data.id = ?
+        ''', (rowid,))
+        session = cursor.fetchone()
+        if session:
+            history_item = build_history_item(cursor, session)
+            history_item['snippet'] = snippets.get(rowid, '')
+            results.append(history_item)
+
+    conn.close()
+    return {
+        'query': text,
+        'page': page,
+        'perPage': per_page,
+        'total': len(ranked_rowids),
+        'hasMore': start + per_page < len(ranked_rowids),
+        'results': results
+    }
+
+def iter_history_batches(batch_size=500, session_ids=None):
+    """Yield lists of sessions as history records, oldest first, one small database read per list"""
+    # Optionally restrict the export to the given sessions
+    session_filter = ''
+    filter_params = []
+    if session_ids is not None:
+        session_filter = f"AND session_id IN ({', '.join('?' * len(session_ids))})"
+        filter_params = list(session_ids)
+
+    last_id = 0
+    while True:
+        # Each batch is a short read so a slow export never holds the database lock
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT * FROM sessions WHERE id > ? {session_filter} ORDER BY id LIMIT ?',
+                       [last_id] + filter_params + [batch_size])
+        sessions = cursor.fetchall()
+
+        records = []
+        for session in sessions:
+            session_id = session['session_id']
+
+            cursor.execute('SELECT * FROM style_data WHERE session_id = ?', (session_id,))
+            style_data_row = cursor.fetchone()
+            cursor.execute('SELECT occasion, image_path FROM generated_images WHERE session_id = ?', (session_id,))
+            images = cursor.fetchall()
+
+            # Same shape as the history data passed to save_history_data_sqlite
+            record = {
+                'session_id': session_id,
+                'timestamp': session['timestamp'],
+                'created_at': session['created_at'],
+                'type': session['type'],
+                'input_image_path': session['input_image_path'],
+                'preview_image': session['preview_image'],
+                'output_images': {img['occasion']: img['image_path'] for img in images}
+            }
+            if style_data_row:
+                record['style_data'] = {
+                    'apparel': style_data_row['apparel'],
+                    'details': json.loads(style_data_row['details'] or '[]'),
+                    'suggestions': {
+                        'party': style_data_row['suggestion_party'],
+                        'office': style_data_row['suggestion_office'],
+                        'vacation': style_data_row['suggestion_vacation']
+                    }
+                }
+            records.append(record)
+        conn.close()
+
+        if not sessions:
+            return
+        yield records
+        last_id = sessions[-1]['id']
+
+def iter_history_records(batch_size=500, session_ids=None):
+    """Yield sessions as history records, oldest first, reading the database in small batches"""
+    for records in iter_history_batches(batch_size, session_ids):
+        yield from records
+
+def export_history_ndjson(session_ids=None):
+    """Stream session history as newline-delimited JSON"""
+    for record in iter_history_records(session_ids=session_ids):
+        yield json.dumps(record) + '\n'
+
+def get_record_image_paths(record):
+    """Return the distinct image paths, relative to public, referenced by a history record"""
+    paths = [record.get('input_image_path')] + list(record.get('output_images', {}).values())
+    # Never hand out files from outside the history folder, whatever the database says
+    return list(dict.fromkeys(path for path in paths if path and is_history_file(get_local_image_path(path))))
+
+class StreamBuffer(io.RawIOBase):
+    """Write-only file object that collects bytes for a streaming response to drain"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def write_history_batch(archive, name, records):
+    """Write records to archive as an NDJSON member followed by the images they reference, yielding after each write"""
+    with archive.open(name, 'w') as sessions_file:
+        for record in records:
+            sessions_file.write((json.dumps(record) + '\n').encode('utf-8'))
+            yield
+
+    for path in dict.fromkeys(path for record in records for path in get_record_image_paths(record)):
+        local_path = get_local_image_path(path)
+        arcname = f"history/{os.path.basename(local_path)}"
+        try:
+            archive.getinfo(arcname)
+            continue  # Shared with a session from an earlier batch
+        except KeyError:
+            pass
+
+        try:
+            src = open(local_path, 'rb')
+        except OSError:
+            continue  # Deleted or compacted since the records were read
+
+        # Images are already compressed, so store them as they are
+        zinfo = zipfile.ZipInfo(arcname, date_time=datetime.datetime.now().timetuple()[:6])
+        with src, archive.open(zinfo, 'w') as dest:
+            while chunk := src.read(64 * 1024):
+                dest.write(chunk)
+                yield
+
+def export_history_zip(session_ids=None):
+    """Stream session history and the images it references as a zip archive"""
+    buffer = StreamBuffer()
+    # The buffer cannot seek, so zipfile writes data descriptors and never rewinds
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # Each batch of sessions is read once and written with its images, so they always agree
+        for batch_number, records in enumerate(iter_history_batches(session_ids=session_ids), 1):
+            for _ in write_history_batch(archive, f"sessions_{batch_number:06d}.ndjson", records):
+                yield buffer.drain()
+    yield buffer.drain()
+
+class HistoryImportError(ValueError):
+    """An import stopped at a bad record; the sessions before it were committed"""
+    def __init__(self, message, imported, skipped):
+        super().__init__(message)
+        self.imported = imported
+        self.skipped = skipped
+
+def parse_history_record(line):
+    """Parse one NDJSON line into a history record, raising ValueError if it is not one"""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError('expected a JSON object')
+    if not isinstance(record.get('session_id'), str) or not record['session_id']:
+        raise ValueError('missing session_id')
+    # insert_history_record reads these as dictionaries
+    style_data = record.get('style_data', {})
+    if not isinstance(style_data, dict) or not isinstance(style_data.get('suggestions', {}), dict):
+        raise ValueError('style_data and its suggestions must be objects')
+    if not isinstance(record.get('output_images', {}), dict):
+        raise ValueError('output_images must be an object')
+    paths = [record.get('input_image_path'), record.get('preview_image')] + list(record.get('output_images', {}).values())
+    if not all(path is None or isinstance(path, str) for path in paths):
+        raise ValueError('image paths must be strings')
+    return record
+
+def import_history_records(lines, batch_size=1000):
+    """Insert history records from NDJSON lines, committing once per batch. Returns (imported, skipped)"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    imported = skipped = pending = 0
+
+    line_number = 0
+    try:
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            record = parse_history_record(line)
+            session_id = record['session_id']
+
+            # Imported paths are untrusted, keep them to plain files in the history folder
+            record['input_image_path'] = sanitize_history_path(record.get('input_image_path'))
+            record['preview_image'] = sanitize_history_path(record.get('preview_image'))
+            record['output_images'] = {
+                occasion: sanitize_history_path(path) for occasion, path in record.get('output_images', {}).items()
+            }
+
+            # Sessions that already exist are left untouched, so re-running an import is safe
+            cursor.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,))
+            if cursor.fetchone():
+                skipped += 1
+                continue
+
+            insert_history_record(cursor, session_id, record.get('timestamp'), record.get('created_at'), record)
+            imported += 1
+            pending += 1
+            if pending >= batch_size:
+                conn.commit()
+                pending = 0
+    except ValueError as e:
+        # Keep the sessions before the bad line, so the caller can fix it and import again
+        conn.commit()
+        conn.close()
+        if isinstance(e, UnicodeDecodeError):
+            # Text is decoded in chunks, so only the last good line is known
+            where = f" after line {line_number}" if line_number else ''
+            raise HistoryImportError(f"not UTF-8 text{where}", imported, skipped) from e
+        raise HistoryImportError(f"line {line_number}: {e}", imported, skipped) from e
+
+    conn.commit()
+    conn.close()
+    return imported, skipped
+
+def import_history_zip(archive_file):
+    """Import an archive written by export_history_zip, restoring missing images. Returns (imported, skipped)"""
+    session_folder = get_session_folder()
+    with zipfile.ZipFile(archive_file) as archive:
+        for name in archive.namelist():
+            if not name.startswith('history/') or name.endswith('/'):
+                continue
+            # Only ever write plain file names into the history folder
+            target_path = os.path.join(session_folder, os.path.basename(name))
+            if not os.path.exists(target_path):
+                with archive.open(name) as src, open(target_path, 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
+
+        imported = skipped = 0
+        for name in sorted(name for name in archive.namelist() if name.endswith('.ndjson')):
+            try:
+                with archive.open(name) as sessions_file:
+                    batch_imported, batch_skipped = import_history_records(io.TextIOWrapper(sessions_file, encoding='utf-8'))
+            except HistoryImportError as e:
+                raise HistoryImportError(f"{name} {e}", imported + e.imported, skipped + e.skipped) from e
+            imported += batch_imported
+            skipped += batch_skipped
+        return imported, skipped
+
+@app.cli.command('export-history')
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--images', is_flag=True, help='Write a zip archive that includes the referenced images.')
+def export_history_command(output, images):
+    """Export session history to OUTPUT as NDJSON, or a zip archive with --images"""
+    if images:
+        with open(output, 'wb') as f:
+            for chunk in export_history_zip():
+                f.write(chunk)
+    else:
+        with open(output, 'w', encoding='utf-8') as f:
+            for line in export_history_ndjson():
+                f.write(line)
+    print(f"Exported session history to {output}")
+
+@app.cli.command('import-history')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_history_command(path):
+    """Import session history from an NDJSON file or zip archive made by export-history"""
+    try:
+        if zipfile.is_zipfile(path):
+            imported, skipped = import_history_zip(path)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                imported, skipped = import_history_records(f)
+    except HistoryImportError as e:
+        print(f"Import stopped: {e}")
+        imported, skipped = e.imported, e.skipped
+    print(f"Imported {imported} sessions, skipped {skipped} that already exist")
+    print(IMPORT_GARMENT_INDEX_HINT)
+
+def get_history_disk_usage():
+    """Return the size in bytes of the image files referenced by saved sessions"""
+    # Files no session references (like single-outfit history) can't be reclaimed, so they don't count
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+    SELECT input_image_path AS path FROM sessions
+    UNION
+    SELECT image_path AS path FROM generated_images
+    ''')
+    local_paths = [get_local_image_path(row['path']) for row in cursor.fetchall() if row['path']]
+    conn.close()
+    local_paths = [path for path in local_paths if is_history_file(path)]
+
+    return sum(os.path.getsize(path) for path in local_paths if os.path.exists(path))
+
+def get_session_disk_usage(cursor, session_id):
+    """Return the size in bytes of the image files a session references"""
+    cursor.execute('SELECT input_image_path FROM sessions WHERE session_id = ?', (session_id,))
+    paths = {row['input_image_path'] for row in cursor.fetchall()}
+    cursor.execute('SELECT image_path FROM generated_images WHERE session_id = ?', (session_id,))
+    paths.update(row['image_path'] for row in cursor.fetchall())
+
+    local_paths = [get_local_image_path(path) for path in paths if path]
+    local_paths = [path for path in local_paths if is_history_file(path)]
+    return sum(os.path.getsize(path) for path in local_paths if os.path.exists(path))
+
+def compact_image(image_path):
+    """Re-encode an image as a smaller WebP file next to it. Returns the new relative path, or None if there is nothing to do"""
+    local_path = get_local_image_path(image_path)
+    if not is_history_file(local_path) or not os.path.exists(local_path) or local_path.endswith('.webp'):
+        return None
+
+    new_image_path = os.path.splitext(image_path)[0] + '.webp'
+    new_local_path = os.path.splitext(local_path)[0] + '.webp'
+    tmp_path = new_local_path + '.tmp'
+
+    try:
+        with Image.open(local_path) as img:
+            # Apply the EXIF orientation, the WebP copy doesn't keep the tag
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGB')
+            img.thumbnail((RETENTION_COMPACT_MAX_SIZE, RETENTION_COMPACT_MAX_SIZE))
+            # Write under a temporary name so a half-written file is never served
+            img.save(tmp_path, 'WEBP', quality=RETENTION_WEBP_QUALITY)
+        os.replace(tmp_path, new_local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return new_image_path
+
+def remove_image_files(image_paths):
+    """Remove images, given as paths relative to public, that exist"""
+    for image_path in image_paths:
+        local_path = get_local_image_path(image_path)
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+def compact_session(session_id):
+    """Recompress a session's images and point its records at the new files. Returns the bytes reclaimed, or None if skipped"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT input_image_path, preview_image FROM sessions WHERE session_id = ? AND storage_tier = 'original'",
+                   (session_id,))
+    session = cursor.fetchone()
+    cursor.execute('SELECT id, image_path FROM generated_images WHERE session_id = ?', (session_id,))
+    images = cursor.fetchall()
+    conn.close()
+    if not session:
+        return None
+
+    # Encode without holding the database, it can take a while
+    new_paths = {}
+    try:
+        for path in [session['input_image_path']] + [img['image_path'] for img in images]:
+            if path and path not in new_paths:
+                new_path = compact_image(path)
+                if new_path:
+                    new_paths[path] = new_path
+    except Exception:
+        # Nothing references the files written so far, so the next pass starts clean
+        remove_image_files(new_paths.values())
+        raise
+
+    # Switch every reference to the new files in one transaction
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+    UPDATE sessions SET input_image_path = ?, preview_image = ?, storage_tier = 'compacted'
+    WHERE session_id = ? AND storage_tier = 'original'
+    ''', (
+        new_paths.get(session['input_image_path'], session['input_image_path']),
+        new_paths.get(session['preview_image'], session['preview_image']),
+        session_id
+    ))
+    if cursor.rowcount == 0:
+        # Compacted by another worker, which wrote the same files, or deleted meanwhile
+        cursor.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,))
+        deleted = cursor.fetchone() is None
+        conn.close()
+        if deleted:
+            remove_image_files(new_paths.values())
+        return None
+
+    for img in images:
+        if img['image_path'] in new_paths:
+            cursor.execute('UPDATE generated_images SET image_path = ? WHERE id = ?',
+                           (new_paths[img['image_path']], img['id']))
+    conn.commit()
+    conn.close()
+
+    # Originals are only removed once nothing references them
+    reclaimed = 0
+    for old_path, new_path in new_paths.items():
+        old_local_path = get_local_image_path(old_path)
+        reclaimed += os.path.getsize(old_local_path) - os.path.getsize(get_local_image_path(new_path))
+        os.remove(old_local_path)
+
+    return reclaimed
+
+def evict_sessions(session_ids, archive_path=None):
+    """Delete sessions, first appending them to the archive at archive_path if given. Returns the bytes reclaimed"""
+    if archive_path:
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        records = list(iter_history_records(session_ids=session_ids))
+
+        # Same format as export-history, so import-history can restore it.
+        # Closing after every batch leaves a complete archive on disk before anything is deleted.
+        with zipfile.ZipFile(archive_path, 'a', zipfile.ZIP_DEFLATED) as archive:
+            batch_number = len([name for name in archive.namelist() if name.endswith('.ndjson')]) + 1
+            for _ in write_history_batch(archive, f"sessions_{batch_number:06d}.ndjson", records):
+                pass
+
+    reclaimed = 0
+    for session_id in session_ids:
+        reclaimed += delete_session_data(session_id) or 0
+        time.sleep(RETENTION_STEP_PAUSE_SECONDS)
+
+    return reclaimed
+
+def iter_retention_batches(condition, params=()):
+    """Yield small batches of session ids matching condition, oldest first"""
+    last_id = 0
+    while True:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT id, session_id FROM sessions WHERE id > ? AND {condition} ORDER BY id LIMIT ?',
+                       [last_id] + list(params) + [RETENTION_BATCH_SIZE])
+        rows = cursor.fetchall()
+        conn.close()
+
+        if not rows:
+            return
+        yield [row['session_id'] for row in rows]
+        last_id = rows[-1]['id']
+
+def run_retention_pass():
+    """Apply the retention policy once, a few sessions at a time. Returns a report, or None if no rule is set or a pass is already running"""
+    if not RETENTION_ENABLED or not retention_lock.acquire(blocking=False):
+        return None
+
+    try:
+        started_at = int(datetime.datetime.now().timestamp() * 1000)
+        budget_bytes = HISTORY_DISK_BUDGET_MB * 1024 * 1024
+        usage_bytes = get_history_disk_usage()
+        report = {'compacted': 0, 'evicted': 0, 'archives': [], 'bytesReclaimed': 0}
+
+        # Everything evicted in one pass goes into a single archive
+        archive_path = None
+        if RETENTION_ARCHIVE_DIR:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            archive_path = os.path.join(RETENTION_ARCHIVE_DIR, f"history_{timestamp}.zip")
+
+        def compact(session_id):
+            nonlocal usage_bytes
+            try:
+                reclaimed = compact_session(session_id)
+            except Exception as e:
+                print(f"Error compacting session {session_id}: {e}")
+                return
+            if reclaimed is None:
+                return
+            report['compacted'] += 1
+            report['bytesReclaimed'] += reclaimed
+            usage_bytes -= reclaimed
+            time.sleep(RETENTION_STEP_PAUSE_SECONDS)
+
+        def evict(session_ids):
+            nonlocal usage_bytes
+            reclaimed = evict_sessions(session_ids, archive_path)
+            report['evicted'] += len(session_ids)
+            report['bytesReclaimed'] += reclaimed
+            if archive_path and archive_path not in report['archives']:
+                report['archives'].append(archive_path)
+            usage_bytes -= reclaimed
+
+        def over_budget():
+            return budget_bytes and usage_bytes > budget_bytes
+
+        # Tier 1: recompress images past the compaction age
+        if RETENTION_COMPACT_AFTER_DAYS:
+            cutoff = started_at - RETENTION_COMPACT_AFTER_DAYS * 24 * 60 * 60 * 1000
+            for batch in iter_retention_batches("storage_tier = 'original' AND created_at < ?", [cutoff]):
+                for session_id in batch:
+                    compact(session_id)
+
+        # Tier 2: evict sessions past the eviction age
+        if RETENTION_EVICT_AFTER_DAYS:
+            cutoff = started_at - RETENTION_EVICT_AFTER_DAYS * 24 * 60 * 60 * 1000
+            for batch in iter_retention_batches('created_at < ?', [cutoff]):
+                evict(batch)
+
+        # Over budget: compact regardless of age, then evict, oldest first
+        if over_budget():
+            for batch in iter_retention_batches("storage_tier = 'original'"):
+                for session_id in batch:
+                    compact(session_id)
+                    if not over_budget():
+                        break
+                if not over_budget():
+                    break
+
+        if over_budget():
+            for batch in iter_retention_batches('1'):
+                # Only evict as many sessions as needed to get back under budget
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                to_evict = []
+                projected_bytes = usage_bytes
+                for session_id in batch:
+                    session_bytes = get_session_disk_usage(cursor, session_id)
+                    if not session_bytes:
+                        continue  # Nothing on disk to reclaim
+                    to_evict.append(session_id)
+                    projected_bytes -= session_bytes
+                    if projected_bytes <= budget_bytes:
+                        break
+                conn.close()
+
+                if to_evict:
+                    evict(to_evict)
+                if not over_budget():
+                    break
+
+        finished_at = int(datetime.datetime.now().timestamp() * 1000)
+        report.update({
+            'startedAt': started_at,
+            'finishedAt': finished_at,
+            'usageBytes': usage_bytes,
+            'budgetBytes': budget_bytes
+        })
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO retention_runs (started_at, finished_at, compacted, evicted, archived, bytes_reclaimed, usage_bytes)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            started_at,
+            finished_at,
+            report['compacted'],
+            report['evicted'],
+            len(report['archives']),
+            report['bytesReclaimed'],
+            usage_bytes
+        ))
+        conn.commit()
+        conn.close()
+
+        return report
+    finally:
+        retention_lock.release()
+
+def retention_worker_loop():
+    """Run retention passes in the background forever"""
+    while True:
+        try:
+            run_retention_pass()
+        except Exception as e:
+            print(f"Error running retention: {e}")
+        time.sleep(RETENTION_INTERVAL_SECONDS)
+
+@app.before_request
+def start_retention_worker():
+    """Start the background retention worker with the first request"""
+    global retention_worker
+    if retention_worker is None and RETENTION_ENABLED and RETENTION_INTERVAL_SECONDS > 0:
+        retention_worker = threading.Thread(target=retention_worker_loop, daemon=True)
+        retention_worker.start()
+
+def get_retention_report(limit=10):
+    """Summarize the retention policy and the space reclaimed so far"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    SELECT COUNT(*) AS runs, COALESCE(SUM(compacted), 0) AS compacted, COALESCE(SUM(evicted), 0) AS evicted,
+           COALESCE(SUM(archived), 0) AS archived, COALESCE(SUM(bytes_reclaimed), 0) AS bytes_reclaimed
+    FROM retention_runs
+    ''')
+    totals = cursor.fetchone()
+    cursor.execute('SELECT * FROM retention_runs ORDER BY id DESC LIMIT ?', (limit,))
+    runs = cursor.fetchall()
+    cursor.execute('SELECT storage_tier, COUNT(*) AS sessions FROM sessions GROUP BY storage_tier')
+    tiers = {row['storage_tier']: row['sessions'] for row in cursor.fetchall()}
+    conn.close()
+
+    return {
+        'policy': {
+            'budgetBytes': HISTORY_DISK_BUDGET_MB * 1024 * 1024,
+            'compactAfterDays': RETENTION_COMPACT_AFTER_DAYS,
+            'evictAfterDays': RETENTION_EVICT_AFTER_DAYS,
+            'archiveDir': RETENTION_ARCHIVE_DIR,
+            'intervalSeconds': RETENTION_INTERVAL_SECONDS
+        },
+        # Measured by the most recent run, so the report never walks the disk
+        'usageBytes': runs[0]['usage_bytes'] if runs else None,
+        'sessionsByTier': tiers,
+        'totals': {
+            'runs': totals['runs'],
+            'compacted': totals['compacted'],
+            'evicted': totals['evicted'],
+            'archived': totals['archived'],
+            'bytesReclaimed': totals['bytes_reclaimed']
+        },
+        'recentRuns': [
+            {
+                'startedAt': run['started_at'],
+                'finishedAt': run['finished_at'],
+                'compacted': run['compacted'],
+                'evicted': run['evicted'],
+                'archived': run['archived'],
+                'bytesReclaimed': run['bytes_reclaimed'],
+                'usageBytes': run['usage_bytes']
+            } for run in runs
+        ]
+    }
+
+@app.cli.command('retention')
+def retention_command():
+    """Apply the history retention policy once and report the space reclaimed"""
+    if not RETENTION_ENABLED:
+        print("No retention rule is set, see HISTORY_DISK_BUDGET_MB, RETENTION_COMPACT_AFTER_DAYS and RETENTION_EVICT_AFTER_DAYS")
+        return
+    report = run_retention_pass()
+    if report is None:
+        print("A retention pass is already running")
+        return
+    print(f"Compacted {report['compacted']} sessions, evicted {report['evicted']}")
+    for archive_path in report['archives']:
+        print(f"Archived evicted sessions to {archive_path}")
+    print(f"Reclaimed {report['bytesReclaimed'] / (1024 * 1024):.1f} MB, history now uses "
+          f"{report['usageBytes'] / (1024 * 1024):.1f} MB")
+
 @app.route('/history/detail/<timestamp>', methods=['GET'])
 def get_history_detail(timestamp):
     """Get detailed information about a specific history entry"""
@@ -674,64 +1772,150 @@ def get_history_endpoint():
         return jsonify(history)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+@app.route('/history/search', methods=['GET'])
+def search_history_endpoint():
+    """Endpoint to search session history"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'No search query provided'}), 400
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    if page < 1 or not 1 <= per_page <= 100:
+        return jsonify({'error': 'page must be at least 1 and per_page between 1 and 100'}), 400
+
+    try:
+        return jsonify(search_history(query, page, per_page))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+@app.route('/history/export', methods=['GET'])
+def export_history_endpoint():
+    """Stream all session history as NDJSON, or as a zip archive with images"""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format == 'ndjson':
+        return Response(stream_with_context(export_history_ndjson()), mimetype='application/x-ndjson',
+                        headers={'Content-Disposition': 'attachment; filename=history.ndjson'})
+    if export_format == 'zip':
+        return Response(stream_with_context(export_history_zip()), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename=history.zip'})
+    return jsonify({'error': 'format must be ndjson or zip'}), 400
+@app.route('/history/import', methods=['POST'])
+def import_history_endpoint():
+    """Import session history from an uploaded NDJSON file or zip archive"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No history file uploaded'}), 400
+
+    history_file = request.files['file']
+    try:
+        if zipfile.is_zipfile(history_file.stream):
+            history_file.stream.seek(0)
+            imported, skipped = import_history_zip(history_file.stream)
+        else:
+            history_file.stream.seek(0)
+            imported, skipped = import_history_records(io.TextIOWrapper(history_file.stream, encoding='utf-8'))
+        return jsonify({
+            'success': True,
+            'imported': imported,
+            'skipped': skipped,
+            'hint': IMPORT_GARMENT_INDEX_HINT
+        })
+    except HistoryImportError as e:
+        return jsonify({
+            'error': f"Import stopped: {e}",
+            'imported': e.imported,
+            'skipped': e.skipped,
+            'hint': IMPORT_GARMENT_INDEX_HINT
+        }), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+@app.route('/retention/report', methods=['GET'])
+def retention_report_endpoint():
+    """Endpoint to report retention policy and space reclaimed"""
+    try:
+        return jsonify(get_retention_report())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+@app.route('/retention/run', methods=['POST'])
+def retention_run_endpoint():
+    """Start a retention pass in the background"""
+    if not RETENTION_ENABLED:
+        return jsonify({'error': 'No retention rule is set'}), 400
+    if retention_lock.locked():
+        return jsonify({'error': 'A retention pass is already running'}), 409
+    threading.Thread(target=run_retention_pass, daemon=True).start()
+    return jsonify({'success': 'Retention pass started'}), 202
 @app.route('/delete-session/<session_id>', methods=['DELETE'])
 def delete_session(session_id):
     """Delete a session and all associated data including files"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Get file paths that need to be deleted
-        # Get input image path
-        cursor.execute('SELECT input_image_path, preview_image FROM sessions WHERE session_id = ?', (session_id,))
-        session_data = cursor.fetchone()
-        if not session_data:
-            conn.close()
+        if delete_session_data(session_id) is None:
             return jsonify({'error': 'Session not found'}), 404
-            
-        files_to_delete = []
-        
-        # Add input image to deletion list
-        if session_data['input_image_path']:
-            input_path = os.path.join('public', session_data['input_image_path'])
-            files_to_delete.append(input_path)
-        
-        # Get all generated image paths
-        cursor.execute('SELECT image_path FROM generated_images WHERE session_id = ?', (session_id,))
-        image_paths = cursor.fetchall()
-        
-        for image in image_paths:
-            if image['image_path']:
-                image_path = os.path.join('public', image['image_path'])
-                files_to_delete.append(image_path)
-        
-        # Delete database records first (due to foreign key constraints)
-        # Delete generated_images records
-        cursor.execute('DELETE FROM generated_images WHERE session_id = ?', (session_id,))
-        
-        # Delete style_data records
-        cursor.execute('DELETE FROM style_data WHERE session_id = ?', (session_id,))
-        
-        # Delete session record
-        cursor.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
-        
-        # Commit database changes
-        conn.commit()
-        conn.close()
-        
-        # Delete files from filesystem
-        for file_path in files_to_delete:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except Exception as file_error:
-                # Log the error but continue with other files
-                print(f"Error deleting file {file_path}: {file_error}")
         
         return jsonify({'success': True, 'message': f'Session {session_id} and all associated data deleted successfully'})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+def delete_session_data(session_id):
+    """Delete a session's records and files. Returns the bytes freed, or None if the session doesn't exist"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    # Get file paths that need to be deleted
+    # Get input image path
+    cursor.execute('SELECT input_image_path, preview_image FROM sessions WHERE session_id = ?', (session_id,))
+    session_data = cursor.fetchone()
+    if not session_data:
+        conn.close()
+        return None
+        
+    files_to_delete = []
+    
+    # Add input image to deletion list
+    if session_data['input_image_path']:
+        input_path = get_local_image_path(session_data['input_image_path'])
+        files_to_delete.append(input_path)
+    
+    # Get all generated image paths
+    cursor.execute('SELECT image_path FROM generated_images WHERE session_id = ?', (session_id,))
+    image_paths = cursor.fetchall()
+    
+    for image in image_paths:
+        if image['image_path']:
+            image_path = get_local_image_path(image['image_path'])
+            files_to_delete.append(image_path)
+    
+    # Delete database records first (due to foreign key constraints)
+    # Delete generated_images records
+    cursor.execute('DELETE FROM generated_images WHERE session_id = ?', (session_id,))
+    
+    # Delete style_data records
+    cursor.execute('DELETE FROM style_data WHERE session_id = ?', (session_id,))
+    
+    # Delete session record
+    cursor.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+    
+    # Commit database changes
+    conn.commit()
+    conn.close()
+    remove_garment_features(session_id)
+    
+    # Delete files from filesystem, but never anything outside the history folder
+    freed = 0
+    for file_path in files_to_delete:
+        if not is_history_file(file_path):
+            print(f"Refusing to delete {file_path}: outside public/history")
+            continue
+        try:
+            if os.path.exists(file_path):
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                freed += size
+        except Exception as file_error:
+            # Log the error but continue with other files
+            print(f"Error deleting file {file_path}: {file_error}")
+    
+    return freed
 initialize_db()
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=port,debug=True)
\ No newline at end of file